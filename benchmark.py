@@ -3,25 +3,42 @@
 Benchmark script to measure voice chat response times
 """
 import asyncio
-import json
+import orjson
+import mmap
 import time
 import websockets
 import statistics
 from typing import List, Dict
 
 class VoiceChatBenchmark:
-    def __init__(self, websocket_url: str = "ws://localhost:8000/ws"):
+    def __init__(self, websocket_url: str = "ws://localhost:8000/ws", realtime: bool = False):
         self.websocket_url = websocket_url
+        self.realtime = realtime  # Pace uploads like a live microphone
         self.pcm_file_path = "client/eval_data/new-version-fast.pcm"
-
-    async def load_test_audio(self) -> bytes:
-        """Load the test PCM audio file"""
-        try:
-            with open(self.pcm_file_path, 'rb') as f:
-                return f.read()
-        except FileNotFoundError:
-            print(f"❌ Test audio file not found: {self.pcm_file_path}")
-            return b""
+        self._audio_view = None
+
+    async def load_test_audio(self) -> memoryview:
+        """Map the test PCM audio file once and return a zero-copy view of it"""
+        if self._audio_view is None:
+            try:
+                with open(self.pcm_file_path, 'rb') as f:
+                    audio_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except FileNotFoundError:
+                print(f"❌ Test audio file not found: {self.pcm_file_path}")
+                return memoryview(b"")
+            self._audio_view = memoryview(audio_map)
+        return self._audio_view
+
+    @staticmethod
+    async def iter_messages(websocket):
+        """Yield decoded server messages, unpacking frames batched into a JSON array"""
+        async for message in websocket:
+            data = orjson.loads(message)
+            if isinstance(data, list):
+                for item in data:
+                    yield item
+            else:
+                yield data
 
     async def run_single_test(self) -> Dict[str, float]:
         """Run a single benchmark test and return timing data"""
@@ -50,17 +67,18 @@ class VoiceChatBenchmark:
                 # Send audio data in chunks (simulate real recording)
                 chunk_size = 3200  # Same as client
                 for i in range(0, len(audio_data), chunk_size):
-                    chunk = audio_data[i:i + chunk_size]
-                    await websocket.send(chunk)
-                    # Small delay to simulate real-time
-                    await asyncio.sleep(0.1)
+                    # Slicing a memoryview does not copy the audio
+                    await websocket.send(audio_data[i:i + chunk_size])
+                    if self.realtime:
+                        # Small delay to simulate real-time
+                        await asyncio.sleep(0.1)
 
                 # Mark upload complete
                 upload_end = time.time()
                 results["upload_time"] = upload_end - upload_start
 
                 # Send end signal
-                await websocket.send(json.dumps({"type": "user_audio_end"}))
+                await websocket.send(orjson.dumps({"type": "user_audio_end"}).decode())  # Text frame
                 print(f"📤 Audio uploaded in {results['upload_time']:.2f}s")
 
                 # Wait for responses and track timing
@@ -68,8 +86,7 @@ class VoiceChatBenchmark:
                 ai_response_complete = False
                 tts_complete = False
 
-                async for message in websocket:
-                    data = json.loads(message)
+                async for data in self.iter_messages(websocket):
                     current_time = time.time()
 
                     if data.get("type") == "interim_transcription":
@@ -121,9 +138,9 @@ class VoiceChatBenchmark:
 
         return results
 
-    async def run_benchmark(self, num_tests: int = 5) -> Dict[str, List[float]]:
+    async def run_benchmark(self, num_tests: int = 5, concurrency: int = 1) -> Dict[str, List[float]]:
         """Run multiple tests and collect statistics"""
-        print(f"\n🚀 Running {num_tests} benchmark tests...\n")
+        print(f"\n🚀 Running {num_tests} benchmark tests (concurrency: {concurrency})...\n")
 
         all_results = {
             "upload_time": [],
@@ -133,20 +150,33 @@ class VoiceChatBenchmark:
             "total_time": []
         }
 
-        for i in range(num_tests):
-            print(f"\n--- Test {i + 1}/{num_tests} ---")
-            result = await self.run_single_test()
+        if concurrency > 1:
+            # Run tests concurrently, at most `concurrency` connections at a time
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def run_limited(i: int) -> Dict[str, float]:
+                async with semaphore:
+                    print(f"\n--- Test {i + 1}/{num_tests} ---")
+                    return await self.run_single_test()
 
+            results = await asyncio.gather(*(run_limited(i) for i in range(num_tests)))
+        else:
+            results = []
+            for i in range(num_tests):
+                print(f"\n--- Test {i + 1}/{num_tests} ---")
+                results.append(await self.run_single_test())
+
+                # Wait between tests
+                if i < num_tests - 1:
+                    print("⏳ Waiting 2s before next test...")
+                    await asyncio.sleep(2)
+
+        for result in results:
             if result:
                 for key in all_results:
                     if key in result:
                         all_results[key].append(result[key])
 
-            # Wait between tests
-            if i < num_tests - 1:
-                print("⏳ Waiting 2s before next test...")
-                await asyncio.sleep(2)
-
         return all_results
 
     def print_statistics(self, results: Dict[str, List[float]]):
@@ -181,11 +211,13 @@ async def main():
     parser = argparse.ArgumentParser(description="Benchmark voice chat response times")
     parser.add_argument("--tests", "-n", type=int, default=5, help="Number of tests to run (default: 5)")
     parser.add_argument("--url", "-u", default="ws://localhost:8000/ws", help="WebSocket URL")
+    parser.add_argument("--realtime", action="store_true", help="Pace audio upload at 10 chunks/sec like a live microphone")
+    parser.add_argument("--concurrency", "-c", type=int, default=1, help="Number of tests to run at once (default: 1, serial)")
 
     args = parser.parse_args()
 
-    benchmark = VoiceChatBenchmark(args.url)
-    results = await benchmark.run_benchmark(args.tests)
+    benchmark = VoiceChatBenchmark(args.url, realtime=args.realtime)
+    results = await benchmark.run_benchmark(args.tests, args.concurrency)
     benchmark.print_statistics(results)
 
 if __name__ == "__main__":
@@ -21,6 +21,47 @@ interface InterimMessage {
 
 type RecordingState = "idle" | "recording" | "processing";
 
+// Binary envelope from the server: 1-byte type tag, uint16 LE length, payload
+const BINARY_INTERIM = 0x01;
+const BINARY_STOP_AUDIO = 0x03;
+const BINARY_AUDIO = 0x04; // Raw 16-bit mono PCM from OpenAI TTS
+const BINARY_AI_TEXT = 0x05;
+const BINARY_AI_COMPLETE = 0x06;
+const PCM_SAMPLE_RATE = 24000;
+const textDecoder = new TextDecoder();
+
+const decodeBinaryFrame = (buffer: ArrayBuffer) => {
+  const view = new DataView(buffer);
+  const tag = view.getUint8(0);
+  const length = view.getUint16(1, true);
+  switch (tag) {
+    case BINARY_INTERIM:
+      return {
+        type: "interim_transcription",
+        text: textDecoder.decode(new Uint8Array(buffer, 3, length)),
+      };
+    case BINARY_STOP_AUDIO:
+      return { type: "stop_audio_playback" };
+    case BINARY_AUDIO:
+      return {
+        type: "audio_stream_pcm",
+        pcm_chunk: buffer.slice(3, 3 + length),
+        sample_rate: PCM_SAMPLE_RATE,
+        channels: 1,
+      };
+    case BINARY_AI_TEXT:
+      return {
+        type: "ai_response_stream",
+        content: textDecoder.decode(new Uint8Array(buffer, 3, length)),
+        is_complete: false,
+      };
+    case BINARY_AI_COMPLETE:
+      return { type: "ai_response_stream", content: "", is_complete: true };
+    default:
+      return { type: `binary_${tag}` };
+  }
+};
+
 function App() {
   const database = useDatabase();
   const [activeChat, setActiveChat] = useState<Chat | null>(null);
@@ -93,8 +134,10 @@ function App() {
   }, [activeChat]);
 
   const { sendMessage, sendJsonMessage, lastMessage, readyState } =
-    useWebSocket("ws://localhost:8000/ws", {
-      onOpen: () => {
+    useWebSocket("ws://localhost:8000/ws?binary=1", {
+      onOpen: (event) => {
+        // Binary envelopes are decoded synchronously from an ArrayBuffer
+        (event.target as WebSocket).binaryType = "arraybuffer";
         console.log("🔌 WebSocket connection established");
         setError(null);
       },
@@ -153,9 +196,7 @@ function App() {
 
   React.useEffect(() => {
     if (lastMessage !== null) {
-      const handleMessage = async () => {
-        const data = JSON.parse(lastMessage.data);
-
+      const handleMessage = async (data: any) => {
         switch (data.type) {
           case "interim_transcription":
             setInterimMessage({
@@ -227,7 +268,22 @@ function App() {
         }
       };
 
-      handleMessage();
+      // The server merges text frames that queue up into a single JSON array
+      let messages: any[];
+      if (lastMessage.data instanceof ArrayBuffer) {
+        messages = [decodeBinaryFrame(lastMessage.data)];
+      } else {
+        const parsed = JSON.parse(lastMessage.data);
+        messages = Array.isArray(parsed) ? parsed : [parsed];
+      }
+
+      const handleMessages = async () => {
+        for (const data of messages) {
+          await handleMessage(data);
+        }
+      };
+
+      handleMessages();
     }
   }, [lastMessage, database, forceCleanupAudio, stopPlayback]);
 
@@ -7,7 +7,7 @@ export function useAudioPlayback() {
 
   // Schedule PCM chunk for precise 2x speed playback using Web Audio API timing
   const playPCMChunkScheduled = useCallback(
-    async (pcmBase64: string, sampleRate: number, channels: number) => {
+    async (pcm: string | ArrayBuffer, sampleRate: number, channels: number) => {
       try {
         // Initialize playback AudioContext if needed
         if (!playbackContextRef.current) {
@@ -22,15 +22,21 @@ export function useAudioPlayback() {
           await context.resume();
         }
 
-        // Decode base64 PCM data
-        const pcmData = atob(pcmBase64);
-        const pcmArray = new Uint8Array(pcmData.length);
-        for (let i = 0; i < pcmData.length; i++) {
-          pcmArray[i] = pcmData.charCodeAt(i);
+        // Binary frames carry raw PCM; JSON frames carry it base64-encoded
+        let pcmBuffer: ArrayBuffer;
+        if (typeof pcm === "string") {
+          const pcmData = atob(pcm);
+          const pcmArray = new Uint8Array(pcmData.length);
+          for (let i = 0; i < pcmData.length; i++) {
+            pcmArray[i] = pcmData.charCodeAt(i);
+          }
+          pcmBuffer = pcmArray.buffer;
+        } else {
+          pcmBuffer = pcm;
         }
 
         // Convert bytes to 16-bit integers
-        const samples = new Int16Array(pcmArray.buffer);
+        const samples = new Int16Array(pcmBuffer);
 
         // Create AudioBuffer
         const audioBuffer = context.createBuffer(
@@ -1,15 +1,47 @@
-import openai
-import json
-from fastapi import WebSocket
-import os
+import orjson
+import re
+import asyncio
+import logging
+import httpx
+from collections import OrderedDict
 from dotenv import load_dotenv
 from pydantic import BaseModel
+from clients import http_client, openai_client, groq_client
+from ws_protocol import ClientWriter
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI clients
-openai.api_key = os.getenv("OPENAI_API_KEY")
+log = logging.getLogger(__name__)
+
+# Characters that end a sentence and trigger TTS
+_SENT_END = frozenset(".!?")
+
+# A terminator run, plus any closing quotes, brackets or markdown emphasis,
+# counts as a sentence boundary once whitespace follows it, so "3.14" and
+# "example.com" never split
+_SENT_BOUNDARY_RE = re.compile(r"[.!?]+[\"'”’)\]*]*(?=\s)")
+_SENT_CLOSERS = "\"'”’)]*"
+
+# A lone capital is only taken for an initial next to another one ("J. K.")
+_INITIAL_RE = re.compile(r'[A-Z]\.')
+_NEXT_INITIAL_RE = re.compile(r'\s+[A-Z]\.')
+
+# Words whose trailing period does not end a sentence
+_ABBREVIATIONS = frozenset({"mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "e.g", "i.e", "u.s", "a.m", "p.m"})
+
+# Before the first sentence completes, a clause this long that ends in
+# , ; or : is sent to TTS on its own so a long opening sentence starts speaking
+FIRST_CLAUSE_MIN_CHARS = 40
+_CLAUSE_BOUNDARY_RE = re.compile(r'[,;:](?=\s)')
+
+# Minimum number of characters to batch into one ai_response_stream frame
+STREAM_FLUSH_CHARS = 48
+
+# Chat stream retries back off from this delay (seconds), doubling per attempt
+CHAT_RETRY_DELAY = 0.5
+_RETRY_STATUSES = frozenset({408, 409, 429})
+
 
 class ResponseModificationAnalysis(BaseModel):
     needs_web_search: bool
@@ -19,16 +51,23 @@ class ResponseModificationAnalysis(BaseModel):
 
 # Note: clean_web_search_response function removed - not needed for Exa+Groq pipeline
 
+# LRU cache of analysis results keyed by normalized transcript
+ANALYSIS_CACHE_SIZE = 512
+_analysis_cache: "OrderedDict[str, ResponseModificationAnalysis]" = OrderedDict()
+
 async def analyze_response_modifications(transcript: str) -> ResponseModificationAnalysis:
     """
     Analyze transcript for both web search needs and TTS speed modifications
     """
-    try:
-        from groq import Groq
+    cache_key = transcript.strip().lower()
+    cached = _analysis_cache.get(cache_key)
+    if cached is not None:
+        _analysis_cache.move_to_end(cache_key)
+        log.debug("🔍🎛️ Analysis cache hit: search=%s, speed=%.1fx", cached.needs_web_search, cached.speed_multiplier)
+        return cached
 
-        groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
-
-        response = groq_client.chat.completions.create(
+    try:
+        response = await groq_client.chat.completions.create(
             model="llama-3.1-8b-instant",  # Latest fast model for analysis (1,800 tokens/sec)
             messages=[
                 {
@@ -53,25 +92,25 @@ Rules:
                 }
             ],
             temperature=0.1,  # Low temperature for consistent JSON
-            max_tokens=200
+            max_tokens=80,  # The schema is tiny
+            response_format={"type": "json_object"}  # Constrain output to valid JSON
         )
 
-        # Parse the JSON response
-        import json
-        result_json = json.loads(response.choices[0].message.content)
-
-        analysis_result = ResponseModificationAnalysis(
-            needs_web_search=result_json["needs_web_search"],
-            has_speed_request=result_json["has_speed_request"],
-            speed_multiplier=result_json["speed_multiplier"],
-            explanation=result_json["explanation"]
+        # Parse and validate the JSON response in one step
+        analysis_result = ResponseModificationAnalysis.model_validate_json(
+            response.choices[0].message.content
         )
 
-        print(f"🔍🎛️ Groq analysis: search={analysis_result.needs_web_search}, speed={analysis_result.speed_multiplier:.1f}x")
+        log.debug("🔍🎛️ Groq analysis: search=%s, speed=%.1fx", analysis_result.needs_web_search, analysis_result.speed_multiplier)
+
+        # Only successful analyses are cached; failures fall through to defaults
+        _analysis_cache[cache_key] = analysis_result
+        if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
         return analysis_result
 
     except Exception as e:
-        print(f"⚠️ Groq analysis failed: {e}")
+        log.warning("⚠️ Groq analysis failed: %s", e)
         return ResponseModificationAnalysis(
             needs_web_search=False,
             has_speed_request=False,
@@ -80,16 +119,28 @@ Rules:
         )
 
 
-async def handle_ai_response(transcription: str, client_websocket: WebSocket, chat_history: list):
+async def handle_ai_response(transcription: str, client_websocket: ClientWriter, chat_history: list, prompt_cache_key: str = None):
     """
     Process final transcription and generate AI response with TTS streaming
     """
     from tts_handlers import get_ai_response_with_sentence_streaming
-    print(f"📝 Starting AI response for: '{transcription}'")
+    log.debug("📝 Starting AI response for: %r", transcription)
+
+    # Speculatively open the regular chat stream while the analysis runs.
+    # It is only consumed if the analysis decides no web search is needed.
+    chat_stream_task = asyncio.create_task(open_chat_stream(transcription, chat_history, prompt_cache_key))
 
     # Analyze transcript for both web search needs and TTS modifications
-    analysis = await analyze_response_modifications(transcription)
-    print(f"🎛️ Analysis: search={analysis.needs_web_search}, speed={analysis.speed_multiplier:.1f}x - {analysis.explanation}")
+    try:
+        analysis = await analyze_response_modifications(transcription)
+    except asyncio.CancelledError:
+        await discard_chat_stream(chat_stream_task)
+        raise
+    log.info("🎛️ Analysis: search=%s, speed=%.1fx - %s", analysis.needs_web_search, analysis.speed_multiplier, analysis.explanation)
+
+    if analysis.needs_web_search:
+        await discard_chat_stream(chat_stream_task)
+        chat_stream_task = None
 
     try:
         ai_response = await get_ai_response_with_sentence_streaming(
@@ -97,9 +148,11 @@ async def handle_ai_response(transcription: str, client_websocket: WebSocket, ch
             client_websocket,
             chat_history=chat_history,
             tts_speed=analysis.speed_multiplier,
-            use_web_search=analysis.needs_web_search
+            use_web_search=analysis.needs_web_search,
+            chat_stream=chat_stream_task,
+            prompt_cache_key=prompt_cache_key,
         )
-        print(f"✅ AI response completed: '{ai_response[:50]}...'")
+        log.info("✅ AI response completed: '%.50s...'", ai_response)
 
         # Send final response back to client
         response = {
@@ -107,85 +160,228 @@ async def handle_ai_response(transcription: str, client_websocket: WebSocket, ch
             "transcription": transcription,
             "ai_response": ai_response,
         }
-        await client_websocket.send_text(json.dumps(response))
-        print(f"📤 Sent final voice_response to client")
+        await client_websocket.send_text(orjson.dumps(response).decode())
+        log.debug("📤 Sent final voice_response to client")
         return ai_response # Return the response for history storage
     except Exception as e:
-        print(f"❌ AI response error: {e}")
+        log.error("❌ AI response error: %s", e)
         error_response = {
             "type": "error",
             "message": f"AI response failed: {e}"
         }
         try:
-            await client_websocket.send_text(json.dumps(error_response))
+            await client_websocket.send_text(orjson.dumps(error_response).decode())
         except Exception as send_error:
-            print(f"❌ Failed to send error response: {send_error}")
+            log.error("❌ Failed to send error response: %s", send_error)
         return None # Return None to indicate failure
 
 
-async def stream_openai_response(text: str, websocket: WebSocket, sentence_handler, chat_history: list, use_web_search: bool = False):
-    """Stream AI response and detect complete sentences"""
-    full_response = ""
-    sentence_buffer = ""
-
+async def open_chat_stream(text: str, chat_history: list, prompt_cache_key: str = None):
+    """Open a streaming Chat Completions request for a non-search query"""
     if text == "[AUDIO_UNCLEAR]":
         user_message = "I didn't hear you clearly. Could you repeat that?"
         system_message = "You are a helpful assistant. The user's audio was unclear, so respond as if you didn't hear them properly. Keep responses conversational and concise."
-        use_search = False
     else:
         user_message = text
         system_message = "You are a helpful assistant. Keep responses conversational and concise."
-        use_search = use_web_search
 
-    if use_search:
-        print(f"🔍⚡ Using fast search (Exa + Groq) for query: '{text}'")
-        # Use fast search pipeline with Exa + Groq
-        from fast_search import fast_search_and_respond
+    # Build messages with chat history
+    messages = [{"role": "system", "content": system_message}]
 
-        return await fast_search_and_respond(user_message, chat_history, websocket, sentence_handler)
-    else:
-        # Use regular Chat Completions for non-search queries with chat history
-        model = "gpt-4o-mini"
+    # Include full chat history for context
+    if chat_history:
+        messages.extend(chat_history)  # Include all messages
 
-        # Build messages with chat history
-        messages = [{"role": "system", "content": system_message}]
+    messages.append({"role": "user", "content": user_message})
 
-        # Include full chat history for context
-        if chat_history:
-            messages.extend(chat_history)  # Include all messages
+    payload = {"model": "gpt-4o-mini", "messages": messages, "stream": True}
+    if prompt_cache_key:
+        # Route every turn of a conversation to the same cache slot; the
+        # history only grows, so each prompt extends the previous prefix
+        payload["prompt_cache_key"] = prompt_cache_key
 
-        messages.append({"role": "user", "content": user_message})
+    # Raw SSE request on the shared pool; the deltas are read by iter_sse_text
+    # without building an SDK model per chunk
+    headers = {
+        "Authorization": f"Bearer {openai_client.api_key}",
+        "Content-Type": "application/json",
+    }
+    if openai_client.organization:
+        headers["OpenAI-Organization"] = openai_client.organization
+    if openai_client.project:
+        headers["OpenAI-Project"] = openai_client.project
+    request = http_client.build_request(
+        "POST",
+        f"{openai_client.base_url}chat/completions",
+        headers=headers,
+        content=orjson.dumps(payload),
+    )
 
-        stream = openai.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True
-        )
+    # Retry like the SDK does: connection errors, 408/409/429 and 5xx
+    for attempt in range(openai_client.max_retries + 1):
+        last_try = attempt == openai_client.max_retries
+        try:
+            response = await http_client.send(request, stream=True)
+        except httpx.TransportError:
+            if last_try:
+                raise
+        else:
+            if response.status_code == 200:
+                break
+            body = await response.aread()
+            await response.aclose()
+            if last_try or not (response.status_code in _RETRY_STATUSES or response.status_code >= 500):
+                raise Exception(f"OpenAI chat stream failed ({response.status_code}): {body[:200]!r}")
+        await asyncio.sleep(CHAT_RETRY_DELAY * 2 ** attempt)
+    return response
 
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                sentence_buffer += content
 
-                stream_response = {
-                    "type": "ai_response_stream",
-                    "content": content,
-                    "is_complete": False
-                }
-                await websocket.send_text(json.dumps(stream_response))
-
-                if any(punct in content for punct in ['.', '!', '?']):
-                    complete_sentence = sentence_buffer.strip()
-                    if len(complete_sentence) > 5:
-                        await sentence_handler(complete_sentence)
-                    sentence_buffer = ""
-
-        completion_response = {
-            "type": "ai_response_stream",
-            "content": "",
-            "is_complete": True
-        }
-        await websocket.send_text(json.dumps(completion_response))
+async def discard_chat_stream(chat_stream_task: asyncio.Task):
+    """Cancel or close a speculative chat stream that will not be consumed"""
+    if not chat_stream_task.done():
+        chat_stream_task.cancel()
+    elif not chat_stream_task.cancelled() and chat_stream_task.exception() is None:
+        await chat_stream_task.result().aclose()
+
+
+async def iter_sse_text(response):
+    """Yield the delta text of a raw Chat Completions SSE response, then close it"""
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[6:]
+            if data == "[DONE]":
+                break
+            event = orjson.loads(data)
+            if "error" in event:
+                error = event["error"]
+                message = error.get("message", error) if isinstance(error, dict) else error
+                raise Exception(f"OpenAI chat stream error: {message}")
+            choices = event["choices"]
+            if choices:
+                content = choices[0]["delta"].get("content")
+                if content:
+                    yield content
+    finally:
+        await response.aclose()
+
+
+async def iter_chunk_text(stream):
+    """Yield the text of each streamed chat completion chunk (Groq SDK stream)"""
+    async for chunk in stream:
+        content = chunk.choices[0].delta.content
+        if content:
+            yield content
+
+
+def split_complete_sentences(text: str):
+    """
+    Split text after its last real sentence boundary, skipping abbreviations
+    and initials. Returns (complete sentences, remainder) or None.
+    """
+    for match in reversed(list(_SENT_BOUNDARY_RE.finditer(text))):
+        if match.group()[0] == ".":
+            words = text[:match.start()].split()
+            word = words[-1].lstrip("\"'“‘([*") if words else ""
+            if word.lower() in _ABBREVIATIONS:
+                continue
+            if len(word) == 1 and word.isupper() and word != "I" and (
+                (len(words) > 1 and _INITIAL_RE.fullmatch(words[-2]))
+                or _NEXT_INITIAL_RE.match(text, match.end())
+            ):
+                continue
+        return text[:match.end()], text[match.end():]
+    return None
+
+
+def split_first_clause(text: str):
+    """Split text after its last clause boundary. Returns (clause, remainder) or None."""
+    match = None
+    for match in _CLAUSE_BOUNDARY_RE.finditer(text):
+        pass
+    if match is None:
+        return None
+    return text[:match.end()], text[match.end():]
+
+
+async def relay_text_stream(deltas, websocket: ClientWriter, sentence_handler):
+    """
+    Forward streamed text to the client in coarse frames and pass each complete
+    sentence to sentence_handler. Returns (full_response, remaining_buffer).
+    """
+    # Accumulate into lists and join on demand; repeated str += is quadratic
+    response_parts = []
+    sentence_parts = []
+    pending_parts = []  # Deltas not yet sent to the client
+    pending_chars = 0
+    sentence_chars = 0
+    recheck = False  # Previous delta ended with a terminator
+    spoken = False  # Whether any text has been handed to TTS yet
+
+    async for content in deltas:
+        response_parts.append(content)
+        sentence_parts.append(content)
+        pending_parts.append(content)
+        pending_chars += len(content)
+        sentence_chars += len(content)
+
+        # Check for sentence boundaries for TTS; a delta ending in "." (or a
+        # closing quote after one) is re-checked when the next one shows
+        # whether whitespace follows
+        split = None
+        if recheck or not _SENT_END.isdisjoint(content):
+            split = split_complete_sentences("".join(sentence_parts))
+        tail = content.rstrip(_SENT_CLOSERS)
+        recheck = tail[-1] in _SENT_END if tail else recheck
+
+        # First audio matters most: speak a long opening clause early
+        if split is None and not spoken and sentence_chars >= FIRST_CLAUSE_MIN_CHARS:
+            split = split_first_clause("".join(sentence_parts))
+
+        # Send coarse chunks to client instead of one frame per delta
+        if split or pending_chars >= STREAM_FLUSH_CHARS:
+            await websocket.send_ai_text("".join(pending_parts))
+            pending_parts = []
+            pending_chars = 0
+
+        if split:
+            # Text after the boundary (e.g. "done. Next") starts the next sentence
+            complete_sentence, remainder = split
+            complete_sentence = complete_sentence.strip()
+            # Skip tiny fragments, except as the first thing spoken
+            if len(complete_sentence) > 5 or (complete_sentence and not spoken):
+                await sentence_handler(complete_sentence)
+                spoken = True
+            sentence_parts = [remainder] if remainder else []
+            sentence_chars = len(remainder)
+
+    # Flush any text still waiting to be sent
+    if pending_parts:
+        await websocket.send_ai_text("".join(pending_parts))
+
+    # Send completion signal
+    await websocket.send_ai_complete()
+
+    return "".join(response_parts), "".join(sentence_parts)
+
+
+async def stream_openai_response(text: str, websocket: ClientWriter, sentence_handler, chat_history: list, use_web_search: bool = False, chat_stream: asyncio.Task = None, prompt_cache_key: str = None):
+    """Stream AI response and detect complete sentences"""
+    use_search = use_web_search and text != "[AUDIO_UNCLEAR]"
+
+    if use_search:
+        log.info("🔍⚡ Using fast search (Exa + Groq) for query: %r", text)
+        # Use fast search pipeline with Exa + Groq
+        from fast_search import fast_search_and_respond
+
+        return await fast_search_and_respond(text, chat_history, websocket, sentence_handler)
+    else:
+        # Use regular Chat Completions for non-search queries with chat history,
+        # reusing the stream opened during analysis when there is one
+        if chat_stream is not None:
+            stream = await chat_stream
+        else:
+            stream = await open_chat_stream(text, chat_history, prompt_cache_key)
 
-        return full_response, sentence_buffer
+        return await relay_text_stream(iter_sse_text(stream), websocket, sentence_handler)
@@ -0,0 +1,34 @@
+import os
+import asyncio
+import logging
+import httpx
+from dotenv import load_dotenv
+from groq import AsyncGroq
+from openai import AsyncOpenAI
+
+# Load environment variables
+load_dotenv()
+
+log = logging.getLogger(__name__)
+
+# Shared connection pool so repeated API calls reuse TCP+TLS connections
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=300),
+    http2=True,
+    timeout=30.0,
+)
+
+openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), http_client=http_client)
+groq_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"), http_client=http_client)
+
+
+async def warm_up_connections():
+    """Open TLS + HTTP/2 connections to OpenAI and Groq so the first turn skips the handshakes"""
+    results = await asyncio.gather(
+        openai_client.models.list(),
+        groq_client.models.list(),
+        return_exceptions=True,
+    )
+    for name, result in zip(("OpenAI", "Groq"), results):
+        if isinstance(result, Exception):
+            log.warning("⚠️ %s connection warm-up failed: %s", name, result)
@@ -1,110 +1,247 @@
 import asyncio
-import json
-from fastapi import WebSocket
-from deepgram import (
-    DeepgramClient,
-    DeepgramClientOptions,
-    LiveTranscriptionEvents,
-    LiveOptions,
-)
-
-async def get_transcript_generator(client_websocket: WebSocket, dg_connection: DeepgramClient, get_tts_state=None, get_ai_task=None):
+import logging
+from ws_protocol import ClientWriter
+from deepgram import DeepgramClient, LiveTranscriptionEvents
+
+log = logging.getLogger(__name__)
+
+# Finalized transcripts waiting for the consumer; the oldest is dropped when full
+TRANSCRIPT_QUEUE_SIZE = 8
+
+# Interim transcripts are coalesced and only the newest is sent on each tick
+INTERIM_FLUSH_INTERVAL = 0.025
+
+# Emit the buffered transcript if Deepgram sends nothing for this long
+FALLBACK_TIMEOUT = 3.0
+
+# Small client audio frames are coalesced before being sent to Deepgram
+AUDIO_BATCH_BYTES = 8192
+AUDIO_BATCH_DELAY = 0.05
+
+
+class AudioBatcher:
     """
-    An async generator that yields transcripts as they are finalized by Deepgram.
+    Buffers outgoing audio and sends it to Deepgram in fewer, larger frames.
+    A batch is sent once it reaches max_bytes or max_delay after its first byte.
     """
-    transcript_queue = asyncio.Queue()
-    transcript_buffer = []  # Accumulate transcript parts
-    last_transcript_time = None  # Track timing for custom fallback
-    has_interrupted = False  # Prevent multiple interruptions for same audio
-
-    async def on_message(self, result, **kwargs):
-        nonlocal last_transcript_time, has_interrupted
-        import time
-        # Note: self and kwargs are required by Deepgram callback signature
-
-        if result.channel.alternatives[0].transcript:
-            transcript = result.channel.alternatives[0].transcript
-
-            # Debug: Show all the flags we're getting
-            print(f"🔍 DEBUG - Transcript: '{transcript}' | is_final: {result.is_final} | speech_final: {result.speech_final}")
-
-            # Update last transcript time for fallback logic
-            last_transcript_time = time.time()
-
-            if not result.speech_final:
-                # Accumulate transcript parts (both interim and final)
-                if result.is_final:
-                    print(f"📝 Final transcript fragment: '{transcript}'")
-                    transcript_buffer.append(transcript)
-                else:
-                    # Send interim results to client for UI
-                    full_interim = " ".join(transcript_buffer + [transcript])
-                    interim_response = {
-                        "type": "interim_transcription",
-                        "text": full_interim.strip()
-                    }
-                    await client_websocket.send_text(json.dumps(interim_response))
-                    
-                    # Check if we should interrupt TTS playback (only once per utterance)
-                    tts_playing = get_tts_state() if get_tts_state else False
-                    
-                    if not has_interrupted and tts_playing:
-                        has_interrupted = True  # Prevent multiple interruptions
-                        print("🛑 Interrupting TTS - user started speaking")
-                        await client_websocket.send_text(json.dumps({
-                            "type": "stop_audio_playback"
-                        }))
-                        
-                        # Cancel the AI task on server side too
-                        if get_ai_task:
-                            ai_task = get_ai_task()
-                            if ai_task and not ai_task.done():
-                                ai_task.cancel()
+
+    def __init__(self, dg_connection, max_bytes=AUDIO_BATCH_BYTES, max_delay=AUDIO_BATCH_DELAY):
+        self.dg_connection = dg_connection
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.buffer = bytearray()
+        self._timer = None
+        self._flush_task = None
+
+    async def add(self, chunk: bytes):
+        # Surface the error of a timer flush that already finished
+        if self._flush_task is not None and self._flush_task.done():
+            task, self._flush_task = self._flush_task, None
+            task.result()
+        self.buffer += chunk
+        if len(self.buffer) >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        previous = self._flush_task
+        self._flush_task = asyncio.create_task(self._send_after(previous, data))
+
+    async def _send_after(self, previous, data: bytes):
+        if previous is not None:
+            await previous  # Keep timer sends in order
+        await self.dg_connection.send(data)
+
+    async def flush(self):
+        """Send everything buffered; raises if a send fails"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            await task  # Earlier audio goes first; its send error is raised here
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        await self.dg_connection.send(data)
+
+    def close(self):
+        """Stop the timer and drop any unsent audio"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        task, self._flush_task = self._flush_task, None
+        if task is not None:
+            if task.done():
+                if not task.cancelled():
+                    task.exception()  # Mark retrieved; the connection is closing anyway
             else:
-                # speech_final=True: User has paused, send complete transcript
-                transcript_buffer.append(transcript)
-                full_transcript = " ".join(transcript_buffer).strip()
-                print(f"✅ Speech final - complete transcript: '{full_transcript}'")
-                await transcript_queue.put(full_transcript)
-                transcript_buffer.clear()  # Reset for next turn
-                has_interrupted = False  # Reset interruption flag for next utterance
-
-    async def on_utterance_end(self, **kwargs):
-        nonlocal has_interrupted
-        # Note: self and kwargs are required by Deepgram callback signature
+                task.cancel()
+        self.buffer.clear()
+
+
+class TranscriptSession:
+    """
+    Per-connection transcript state. Deepgram callbacks update it and finalized
+    transcripts are queued for the consumer.
+    """
+
+    def __init__(self, client_websocket: ClientWriter, dg_connection: DeepgramClient, state=None):
+        self.client_websocket = client_websocket
+        self.dg_connection = dg_connection
+        self.state = state  # Shared namespace with tts_playing and ai_task
+        self.queue = asyncio.Queue(maxsize=TRANSCRIPT_QUEUE_SIZE)  # Bounded to cap memory
+        self.buffer = []  # Accumulate transcript parts
+        self.finalized_prefix = ""  # " ".join(buffer), maintained incrementally
+        self.has_interrupted = False  # Prevent multiple interruptions for same audio
+        self.latest_interim = None  # Newest interim text not yet sent to the client
+        self.last_sent_interim = None  # Deepgram often repeats a partial; skip re-sending it
+        self.interim_ready = asyncio.Event()  # Set when latest_interim has new text
+        self.fallback_handle = None  # Timer for the custom timeout fallback
+        self.loop = asyncio.get_running_loop()
+        self._interim_task = None
+        self.ended = False  # Set once the audio stream is over
+
+    def start(self):
+        # Start background interim sender (stored for cleanup)
+        self._interim_task = asyncio.create_task(self.interim_flusher())
+        self.dg_connection.on(LiveTranscriptionEvents.Transcript, self.on_message)
+        self.dg_connection.on(LiveTranscriptionEvents.UtteranceEnd, self.on_utterance_end)
+
+    def close(self):
+        if self.fallback_handle:
+            self.fallback_handle.cancel()
+        if self._interim_task:
+            self._interim_task.cancel()
+
+    def end(self):
+        """Queue any leftover speech, then let transcripts() finish"""
+        if self.ended:
+            return
+        if self.buffer:
+            self.finalize()
+        self.enqueue_transcript(None)
+        self.ended = True
+
+    def enqueue_transcript(self, full_transcript: str):
+        """Queue a finalized transcript without awaiting, replacing the oldest if full"""
+        if self.ended:
+            return
+        try:
+            self.queue.put_nowait(full_transcript)
+        except asyncio.QueueFull:
+            dropped = self.queue.get_nowait()
+            log.warning("⚠️ Transcript queue full, dropping oldest: %r", dropped)
+            self.queue.put_nowait(full_transcript)
+
+    def finalize(self):
+        """Queue the buffered transcript and reset state for the next turn"""
+        full_transcript = " ".join(self.buffer).strip()
+        self.latest_interim = None  # Drop stale interim
+        self.last_sent_interim = None
+        self.enqueue_transcript(full_transcript)
+        self.buffer.clear()
+        self.finalized_prefix = ""
+        self.has_interrupted = False  # Reset interruption flag for next utterance
+        return full_transcript
+
+    async def on_message(self, _client, result, **kwargs):
+        # Note: the client arg and kwargs are required by Deepgram callback signature
+        transcript = result.channel.alternatives[0].transcript
+        if not transcript:
+            return
+
+        is_final = result.is_final
+        speech_final = result.speech_final
+
+        # Debug: Show all the flags we're getting
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("🔍 Transcript: %r | is_final: %s | speech_final: %s", transcript, is_final, speech_final)
+
+        # Re-arm the fallback timer for this transcript
+        if self.fallback_handle:
+            self.fallback_handle.cancel()
+        self.fallback_handle = self.loop.call_later(FALLBACK_TIMEOUT, self.fire_timeout_fallback)
+
+        if speech_final:
+            # speech_final=True: User has paused, send complete transcript
+            self.buffer.append(transcript)
+            full_transcript = self.finalize()
+            log.info("✅ Speech final - complete transcript: %r", full_transcript)
+        elif is_final:
+            # Accumulate transcript parts (both interim and final)
+            log.debug("📝 Final transcript fragment: %r", transcript)
+            self.buffer.append(transcript)
+            prefix = self.finalized_prefix
+            self.finalized_prefix = f"{prefix} {transcript}" if prefix else transcript
+        else:
+            # Queue interim result for the client UI; the flusher sends the newest one
+            prefix = self.finalized_prefix
+            full_interim = f"{prefix} {transcript}" if prefix else transcript
+            self.latest_interim = full_interim.strip()
+            self.interim_ready.set()
+
+            # Check if we should interrupt TTS playback (only once per utterance)
+            state = self.state
+            if not self.has_interrupted and state is not None and state.tts_playing:
+                self.has_interrupted = True  # Prevent multiple interruptions
+                log.info("🛑 Interrupting TTS - user started speaking")
+                await self.client_websocket.send_stop_audio()
+
+                # Cancel the AI task on server side too
+                ai_task = state.ai_task
+                if ai_task and not ai_task.done():
+                    ai_task.cancel()
+
+    async def on_utterance_end(self, _client, **kwargs):
+        # Note: the client arg and kwargs are required by Deepgram callback signature
         # UtteranceEnd triggered when speech_final fails due to background noise
-        if transcript_buffer:  # Only if we have accumulated transcript
-            full_transcript = " ".join(transcript_buffer).strip()
-            print(f"🔚 UtteranceEnd - complete transcript: '{full_transcript}'")
-            await transcript_queue.put(full_transcript)
-            transcript_buffer.clear()
-            has_interrupted = False  # Reset interruption flag
-
-    async def custom_timeout_fallback():
+        if self.buffer:  # Only if we have accumulated transcript
+            full_transcript = self.finalize()
+            log.info("🔚 UtteranceEnd - complete transcript: %r", full_transcript)
+
+    def fire_timeout_fallback(self):
         """Fallback: If no speech_final after 3 seconds, manually trigger"""
-        nonlocal has_interrupted
-        import time
-        while True:
-            await asyncio.sleep(1)  # Check every second
-            if (last_transcript_time and transcript_buffer and
-                time.time() - last_transcript_time > 3.0):  # 3 second timeout
-                full_transcript = " ".join(transcript_buffer).strip()
-                print(f"⏰ Custom timeout fallback - complete transcript: '{full_transcript}'")
-                await transcript_queue.put(full_transcript)
-                transcript_buffer.clear()
-                has_interrupted = False  # Reset interruption flag
-
-    # Start background timeout task (variable stored for potential cleanup)
-    _timeout_task = asyncio.create_task(custom_timeout_fallback())
-
-    dg_connection.on(LiveTranscriptionEvents.Transcript, on_message)
-    dg_connection.on(LiveTranscriptionEvents.UtteranceEnd, on_utterance_end)
-
-    try:
+        self.fallback_handle = None
+        if self.buffer:
+            full_transcript = self.finalize()
+            log.info("⏰ Custom timeout fallback - complete transcript: %r", full_transcript)
+
+    async def interim_flusher(self):
+        """Send only the newest interim transcript once per tick"""
         while True:
-            transcript = await transcript_queue.get()
-            yield transcript
-    except asyncio.CancelledError:
-        print("Transcript generator cancelled.")
-    finally:
-        print("Transcript generator finished.")
\ No newline at end of file
+            await self.interim_ready.wait()
+            await asyncio.sleep(INTERIM_FLUSH_INTERVAL)  # Let partials in this tick coalesce
+            self.interim_ready.clear()
+            if self.latest_interim is not None:
+                text, self.latest_interim = self.latest_interim, None
+                if text != self.last_sent_interim:
+                    self.last_sent_interim = text
+                    try:
+                        await self.client_websocket.send_interim(text)
+                    except Exception as e:
+                        # The writer has failed; it already logged the error
+                        log.debug("Interim flusher stopped: %s", e)
+                        return
+
+    async def transcripts(self):
+        """Yield transcripts as they are finalized by Deepgram, until end() is called"""
+        self.start()
+        try:
+            while True:
+                transcript = await self.queue.get()
+                if transcript is None:
+                    break
+                yield transcript
+        except asyncio.CancelledError:
+            log.debug("Transcript generator cancelled.")
+            raise
+        finally:
+            self.close()
+            log.debug("Transcript generator finished.")
+
@@ -1,76 +1,89 @@
 import os
-import json
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
 from dotenv import load_dotenv
 from exa_py import Exa
-from groq import Groq
-from fastapi import WebSocket
+from clients import groq_client
+from ai_handlers import iter_chunk_text, relay_text_stream
+from ws_protocol import ClientWriter
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 # Initialize clients
 exa_client = Exa(api_key=os.getenv("EXA_API_KEY"))
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
-async def rewrite_query_for_search(query: str, chat_history: list) -> str:
+# LRU cache of Exa results keyed by normalized search query; entries expire
+# so answers about current events stay fresh
+SEARCH_CACHE_SIZE = 512
+SEARCH_CACHE_TTL = 900.0
+_search_cache: "OrderedDict[str, tuple]" = OrderedDict()
+_NORMALIZE_RE = re.compile(r"[^\w\s]+")
+
+def normalize_search_query(query: str) -> str:
+    """Lowercase and strip punctuation so trivially different phrasings share a cache entry"""
+    return " ".join(_NORMALIZE_RE.sub(" ", query.lower()).split())
+
+async def search_exa(search_query: str):
+    """Exa search with results cached per normalized query"""
+    cache_key = normalize_search_query(search_query)
+    cached = _search_cache.get(cache_key)
+    if cached is not None:
+        stored_at, results = cached
+        if time.monotonic() - stored_at < SEARCH_CACHE_TTL:
+            _search_cache.move_to_end(cache_key)
+            log.debug("🔍 Exa cache hit for: %r", cache_key)
+            return results
+        del _search_cache[cache_key]
+
+    log.debug("🔍 Searching with Exa...")
+    results = await asyncio.to_thread(  # Exa's SDK is blocking
+        exa_client.search_and_contents,
+        search_query,
+        text={
+            "max_chars": 500
+        },
+        type="auto",
+        num_results=4,  # Get top 5 results
+    )
+
+    _search_cache[cache_key] = (time.monotonic(), results)
+    if len(_search_cache) > SEARCH_CACHE_SIZE:
+        _search_cache.popitem(last=False)
+    return results
+
+# Pronouns that usually point back into the conversation
+_REFERENCE_RE = re.compile(r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her)\b", re.IGNORECASE)
+
+def build_search_query(query: str, chat_history: list) -> str:
     """
-    Use Groq to rewrite a conversational query into a standalone search query.
+    Make a conversational query usable for web search without an extra LLM call.
+    Follow-ups that refer back to the conversation are prefixed with the previous
+    user question; the answer model still sees the full chat history.
     """
-    if not chat_history:
+    if not chat_history or not _REFERENCE_RE.search(query):
         return query
 
-    print("🧠 Rewriting query for search context...")
-
-    try:
-        history_str = "\n".join([f"{msg.get('role')}: {msg.get('content')}" for msg in chat_history])
-        
-        prompt = f"""Based on the chat history and the user's latest query, rewrite the query into a standalone, self-contained question suitable for a web search.
-
-<chat-history>
-{history_str}
-</chat-history>
-
-<latest-query>
-{query}
-</latest-query>
+    for msg in reversed(chat_history):
+        if msg.get("role") == "user" and msg.get("content"):
+            return f"{msg['content']} {query}"
+    return query
 
-Provide ONLY the rewritten search query and nothing else.
-"""
-        
-        completion = groq_client.chat.completions.create(
-            model="llama-3.1-8b-instant",
-            messages=[
-                {"role": "system", "content": "You are a query rewriting expert."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
-            max_tokens=100
-        )
-        rewritten_query = completion.choices[0].message.content.strip()
-        print(f"🔍 Rewritten query: '{rewritten_query}'")
-        return rewritten_query
-    except Exception as e:
-        print(f"⚠️ Query rewrite failed: {e}. Using original query.")
-        return query
-
-async def fast_search_and_respond(query: str, chat_history: list, websocket: WebSocket, sentence_handler):
+async def fast_search_and_respond(query: str, chat_history: list, websocket: ClientWriter, sentence_handler):
     """
     Fast research pipeline using Exa search + Groq summarization
     """
-    # Step 1: Rewrite query for context
-    search_query = await rewrite_query_for_search(query, chat_history)
-    print(f"🔍⚡ Starting fast search for: '{search_query}'")
+    # Step 1: Make the query standalone for search
+    search_query = build_search_query(query, chat_history)
+    log.debug("🔍⚡ Starting fast search for: %r", search_query)
 
     try:
         # Step 2: Search with Exa
-        print("🔍 Searching with Exa...")
-        search_results = exa_client.search_and_contents(
-            search_query,
-            text={
-                "max_chars": 500
-            },
-            type="auto",
-            num_results=4,  # Get top 5 results
-        )
+        search_results = await search_exa(search_query)
 
         # Step 2: Build context for Groq using XML tags for clarity
         context_parts = []
@@ -110,8 +123,8 @@ async def fast_search_and_respond(query: str, chat_history: list, websocket: Web
         ]
 
         # Step 5: Stream response from Groq
-        print("⚡ Generating response with Groq...")
-        completion = groq_client.chat.completions.create(
+        log.debug("⚡ Generating response with Groq...")
+        completion = await groq_client.chat.completions.create(
             model="llama-3.3-70b-versatile",  # Latest high-quality model
             messages=messages,
             temperature=0.7,
@@ -119,42 +132,13 @@ async def fast_search_and_respond(query: str, chat_history: list, websocket: Web
             stream=True
         )
 
-        # Stream processing
-        full_response = ""
-        sentence_buffer = ""
-
-        for chunk in completion:
-            if chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                sentence_buffer += content
-
-                # Send chunk to client
-                stream_response = {
-                    "type": "ai_response_stream",
-                    "content": content,
-                    "is_complete": False
-                }
-                await websocket.send_text(json.dumps(stream_response))
-
-                # Check for sentence boundaries for TTS
-                if any(punct in content for punct in ['.', '!', '?']):
-                    complete_sentence = sentence_buffer.strip()
-                    if len(complete_sentence) > 5:
-                        await sentence_handler(complete_sentence)
-                    sentence_buffer = ""
-
-        # Send completion signal
-        completion_response = {
-            "type": "ai_response_stream",
-            "content": "",
-            "is_complete": True
-        }
-        await websocket.send_text(json.dumps(completion_response))
-
-        print(f"⚡✅ Fast search completed: '{full_response[:50]}...'")
-        return full_response, sentence_buffer
+        full_response, remaining_buffer = await relay_text_stream(
+            iter_chunk_text(completion), websocket, sentence_handler
+        )
+
+        log.info("⚡✅ Fast search completed: '%.50s...'", full_response)
+        return full_response, remaining_buffer
 
     except Exception as e:
-        print(f"❌ Fast search error: {e}")
+        log.error("❌ Fast search error: %s", e)
         raise Exception(f"Fast search failed: {e}")
\ No newline at end of file
@@ -1,15 +1,24 @@
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 import os
-import json
+import logging
+import orjson
 import asyncio
+import uuid
+from types import SimpleNamespace
 from dotenv import load_dotenv
 from deepgram import DeepgramClient, DeepgramClientOptions, LiveOptions
-from deepgram_handler import get_transcript_generator
+from deepgram_handler import TranscriptSession, AudioBatcher
 from ai_handlers import handle_ai_response
+from ws_protocol import ClientWriter
+from clients import http_client, warm_up_connections
 
 load_dotenv()
 
+# Handlers log through `logging`; set LOG_LEVEL=DEBUG for per-transcript output
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(message)s")
+log = logging.getLogger(__name__)
+
 app = FastAPI(title="RapidAnswer API", version="1.0.0")
 
 app.add_middleware(
@@ -28,6 +37,36 @@ if DEEPGRAM_API_KEY is None:
 else:
     print("✅ DEEPGRAM_API_KEY loaded.")
 
+# One Deepgram client for the process; each WebSocket only opens its own live connection
+deepgram: DeepgramClient = DeepgramClient(
+    DEEPGRAM_API_KEY, DeepgramClientOptions(options={"keepalive": "true"})
+)
+
+# Live transcription options are the same for every connection
+LIVE_OPTIONS = LiveOptions(
+    model="nova-2",
+    punctuate=True,
+    language="en-US",
+    encoding="linear16",
+    channels=1,
+    sample_rate=16000,
+    smart_format=True,
+    interim_results=True,  # Required for utterance_end_ms
+    endpointing=1200,  # Balance: 1.2s to allow complete thoughts
+    utterance_end_ms=2500,  # Longer backup for complete utterances
+    no_delay=True,  # Fix for speech_final not triggering
+)
+
+@app.on_event("startup")
+async def warm_up_http_client():
+    await warm_up_connections()
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+
 @app.get("/")
 async def root():
     return {"message": "RapidAnswer API is running!"}
@@ -36,94 +75,87 @@ async def root():
 @app.websocket("/ws")
 async def websocket_endpoint(client_websocket: WebSocket):
     await client_websocket.accept()
-    print("WebSocket connection established")
+    log.info("WebSocket connection established")
+
+    # All outgoing frames go through one writer task; ?binary=1 opts into binary envelopes
+    client_writer = ClientWriter(client_websocket, binary=client_websocket.query_params.get("binary") == "1")
+    client_writer.start()
 
-    ai_task = None
     chat_history = []  # Store conversation history for this connection
-    is_tts_playing = False  # Track TTS playback state for interruption
+    prompt_cache_key = uuid.uuid4().hex  # Pins this conversation's prompt prefix cache
+    # TTS playback state and current AI task, shared with the transcript callbacks for interruption
+    state = SimpleNamespace(tts_playing=False, ai_task=None)
     
     try:
-        config = DeepgramClientOptions(options={"keepalive": "true"})
-        deepgram: DeepgramClient = DeepgramClient(DEEPGRAM_API_KEY, config)
         dg_connection = deepgram.listen.asynclive.v("1")
         
-        # Pass TTS state and AI task getters to transcript generator for interruption detection
-        transcript_generator = get_transcript_generator(
-            client_websocket, 
-            dg_connection,
-            lambda: is_tts_playing,
-            lambda: ai_task
-        )
-
-        options = LiveOptions(
-            model="nova-2",
-            punctuate=True,
-            language="en-US",
-            encoding="linear16",
-            channels=1,
-            sample_rate=16000,
-            smart_format=True,
-            interim_results=True,  # Required for utterance_end_ms
-            endpointing=1200,  # Balance: 1.2s to allow complete thoughts
-            utterance_end_ms=2500,  # Longer backup for complete utterances
-            no_delay=True,  # Fix for speech_final not triggering
-        )
-        await dg_connection.start(options)
+        # Pass the shared state to the transcript session for interruption detection
+        transcript_session = TranscriptSession(client_writer, dg_connection, state)
+        transcript_generator = transcript_session.transcripts()
+
+        await dg_connection.start(LIVE_OPTIONS)
 
         async def forward_audio():
+            """Forward client audio to Deepgram; returns True if the client is still connected"""
+            batcher = AudioBatcher(dg_connection)
             try:
                 while True:
                     message = await client_websocket.receive()
                     if message["type"] == "websocket.disconnect":
-                        print("Client disconnected. Closing Deepgram connection.")
+                        log.info("Client disconnected. Closing Deepgram connection.")
+                        await batcher.flush()
                         await dg_connection.finish()
-                        break
+                        return False
                     if message["type"] == "websocket.receive" and "bytes" in message:
-                        await dg_connection.send(message["bytes"])
+                        await batcher.add(message["bytes"])
                     elif message["type"] == "websocket.receive" and "text" in message:
-                        data = json.loads(message["text"])
+                        data = orjson.loads(message["text"])
                         if data.get("type") == "user_audio_end":
-                            print("Client sent stop signal. Closing stream.")
+                            log.info("Client sent stop signal. Closing stream.")
+                            await batcher.flush()
                             await dg_connection.finish()
-                            break
+                            return True
             except Exception as e:
-                print(f"Error forwarding audio: {e}")
+                log.error("Error forwarding audio: %s", e)
+                return False
             finally:
+                batcher.close()  # No timer flush may fire after finish()
                 if dg_connection:
                     await dg_connection.finish()
+                transcript_session.end()  # No more audio, so no more transcripts
 
         async def handle_transcripts():
-            nonlocal ai_task, chat_history, is_tts_playing
-
             async for complete_transcript in transcript_generator:
                 # transcript_generator now only yields when speech_final=True
-                print(f"User finished speaking. Complete transcript: '{complete_transcript}'")
+                log.debug("User finished speaking. Complete transcript: %r", complete_transcript)
 
                 # Cancel any ongoing AI response (barge-in)
-                if ai_task and not ai_task.done():
-                    print("Barge-in detected. Cancelling previous AI response.")
-                    ai_task.cancel()
-                    await client_websocket.send_text(json.dumps({"type": "stop_audio_playback"}))
-                    is_tts_playing = False  # Stop playing on cancellation
+                if state.ai_task and not state.ai_task.done():
+                    log.info("Barge-in detected. Cancelling previous AI response.")
+                    state.ai_task.cancel()
+                    await client_writer.send_stop_audio()
+                    state.tts_playing = False  # Stop playing on cancellation
                 
                 # Only reset TTS state if it wasn't already interrupted
                 # This keeps the state accurate for interruption detection
-                if is_tts_playing:
-                    is_tts_playing = False
+                if state.tts_playing:
+                    state.tts_playing = False
 
                 # Start AI response immediately (no additional timer needed)
-                is_tts_playing = True  # Mark TTS as starting
-                ai_task = asyncio.create_task(handle_ai_response(complete_transcript, client_websocket, chat_history))
-
-                try:
-                    # Wait for AI task to complete and update chat history
-                    ai_response = await ai_task
-                    # Don't set is_tts_playing to False here - audio is still playing on client!
-                    # It will be set to False when the next utterance starts
-                except asyncio.CancelledError:
-                    print("AI task was cancelled due to interruption")
+                state.tts_playing = True  # Mark TTS as starting
+                ai_task = state.ai_task = asyncio.create_task(handle_ai_response(complete_transcript, client_writer, chat_history, prompt_cache_key))
+
+                # Wait for AI task to complete and update chat history. asyncio.wait
+                # keeps our own cancellation apart from a barge-in cancelling ai_task.
+                await asyncio.wait((ai_task,))
+                if ai_task.cancelled():
+                    log.info("AI task was cancelled due to interruption")
                     ai_response = None
-                    is_tts_playing = False  # Only set to False on cancellation
+                    state.tts_playing = False  # Only set to False on cancellation
+                else:
+                    # Don't set state.tts_playing to False here - audio is still playing on client!
+                    # It will be set to False when the next utterance starts
+                    ai_response = ai_task.result()
                 if ai_response:
                     # Update chat history with this successful exchange
                     chat_history.append({"role": "user", "content": complete_transcript})
@@ -131,20 +163,37 @@ async def websocket_endpoint(client_websocket: WebSocket):
 
                     # No message limit - keep full conversation history
 
-        await asyncio.gather(forward_audio(), handle_transcripts())
+        audio_task = asyncio.create_task(forward_audio())
+        transcript_task = asyncio.create_task(handle_transcripts())
+        try:
+            done, _ = await asyncio.wait((audio_task, transcript_task), return_when=asyncio.FIRST_COMPLETED)
+            if transcript_task in done:
+                transcript_task.result()  # Raise a failure of the transcript loop
+            elif audio_task.result():
+                # Client sent the stop signal: answer what it said before closing,
+                # and let the writer deliver the queued audio and voice_response
+                await transcript_task
+                await client_writer.close(drain=True)
+        finally:
+            # Whichever loop is still running stops with the other
+            audio_task.cancel()
+            transcript_task.cancel()
+            await asyncio.gather(audio_task, transcript_task, return_exceptions=True)
+            await transcript_generator.aclose()  # Stops the interim flusher and fallback timer
 
     except Exception as e:
-        print(f"❌ WebSocket handler error: {e}")
+        log.error("❌ WebSocket handler error: %s", e)
     finally:
-        if ai_task and not ai_task.done():
-            ai_task.cancel()
+        if state.ai_task and not state.ai_task.done():
+            state.ai_task.cancel()
+        await client_writer.close()
         try:
             await client_websocket.close()
-            print("🔌 WebSocket connection closed")
+            log.info("🔌 WebSocket connection closed")
         except Exception:
-            print("🔌 WebSocket connection already closed.")
+            log.info("🔌 WebSocket connection already closed.")
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000, loop="uvloop", http="httptools")
\ No newline at end of file
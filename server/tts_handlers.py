@@ -1,60 +1,46 @@
-import openai
-import json
 import asyncio
-import base64
-from openai import AsyncOpenAI
-from fastapi import WebSocket
-import os
-from dotenv import load_dotenv
+import logging
+from clients import openai_client
+from ws_protocol import ClientWriter
 
-# Load environment variables
-load_dotenv()
+log = logging.getLogger(__name__)
 
-# Initialize OpenAI clients
-openai.api_key = os.getenv("OPENAI_API_KEY")
-async_openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# PCM bytes per audio frame at 24 kHz 16-bit mono: a 20 ms first frame so
+# playback starts early, then doubling up to 200 ms
+TTS_FRAME_SIZES = (960, 1920, 3840, 7680, 9600)
 
 
-async def manage_audio_queue(audio_queue: asyncio.Queue, websocket: WebSocket):
-    """Send audio chunks from queue to client"""
-    print("🎵 Audio queue manager started")
-    try:
-        while True:
-            chunk = await audio_queue.get()
-            if chunk is None:
-                # Sentinel value received, stop sending
-                print("🛑 Audio queue received stop signal")
-                audio_queue.task_done()
-                break
-
-            await websocket.send_text(json.dumps(chunk))
-            audio_queue.task_done()
-    except Exception as e:
-        print(f"❌ Audio queue error: {e}")
-    finally:
-        print("🏁 Audio queue manager stopped")
+async def iter_progressive_frames(byte_stream):
+    """Re-chunk a PCM byte stream into frames following TTS_FRAME_SIZES"""
+    buffer = bytearray()
+    sizes = iter(TTS_FRAME_SIZES)
+    size = next(sizes)
+    async for data in byte_stream:
+        buffer += data
+        while len(buffer) >= size:
+            yield bytes(buffer[:size])
+            del buffer[:size]
+            size = next(sizes, size)
+    if buffer:
+        yield bytes(buffer)
 
 
-async def get_ai_response_with_sentence_streaming(text: str, websocket: WebSocket, chat_history: list, tts_speed: float = 2.0, use_web_search: bool = False) -> str:
+async def get_ai_response_with_sentence_streaming(text: str, websocket: ClientWriter, chat_history: list, tts_speed: float = 2.0, use_web_search: bool = False, chat_stream: asyncio.Task = None, prompt_cache_key: str = None) -> str:
     """
     Get AI response from OpenAI API with sentence-by-sentence TTS streaming
     """
     from ai_handlers import stream_openai_response # Import here to avoid circular dependency
     tts_tasks = []
-    audio_queue = asyncio.Queue()
     full_response = ""
 
     # The first sentence doesn't have to wait for anything.
     previous_sentence_done = asyncio.Event()
     previous_sentence_done.set()
 
-    # Start the dedicated audio sender task
-    sender_task = asyncio.create_task(manage_audio_queue(audio_queue, websocket))
-
     async def handle_sentence(sentence):
         """Process a complete sentence for TTS"""
         nonlocal previous_sentence_done
-        print(f"🎵 Starting TTS for sentence: {sentence}")
+        log.debug("🎵 Starting TTS for sentence: %s", sentence)
 
         # This event will be set when the current sentence is done.
         current_sentence_done = asyncio.Event()
@@ -62,7 +48,7 @@ async def get_ai_response_with_sentence_streaming(text: str, websocket: WebSocke
         # Start TTS, passing the gates for ordering.
         task = asyncio.create_task(synthesize_speech_streaming(
             text=sentence,
-            audio_queue=audio_queue,
+            websocket=websocket,
             wait_for_event=previous_sentence_done,
             set_event_when_done=current_sentence_done,
             speed=tts_speed
@@ -74,11 +60,11 @@ async def get_ai_response_with_sentence_streaming(text: str, websocket: WebSocke
 
     try:
         # Stream response and handle sentences
-        full_response, remaining_buffer = await stream_openai_response(text, websocket, handle_sentence, chat_history, use_web_search)
+        full_response, remaining_buffer = await stream_openai_response(text, websocket, handle_sentence, chat_history, use_web_search, chat_stream, prompt_cache_key)
 
         # Handle any remaining text in buffer
         if remaining_buffer.strip():
-            print(f"🎵 Starting TTS for final fragment: {remaining_buffer.strip()}")
+            log.debug("🎵 Starting TTS for final fragment: %s", remaining_buffer.strip())
             await handle_sentence(remaining_buffer.strip())
 
         # Wait for all TTS tasks to complete before returning
@@ -86,53 +72,60 @@ async def get_ai_response_with_sentence_streaming(text: str, websocket: WebSocke
             await asyncio.gather(*tts_tasks)
 
     except asyncio.CancelledError:
-        print("AI response task cancelled.")
+        log.info("AI response task cancelled.")
     except Exception as e:
-        print(f"OpenAI streaming error: {e}")
+        log.error("OpenAI streaming error: %s", e)
         raise Exception(f"AI response generation failed: {e}")
     finally:
-        # Signal the sender to stop and wait for it to finish
-        await audio_queue.put(None)
-        await sender_task
+        # Stop any TTS still streaming so no audio follows a cancelled response
+        for task in tts_tasks:
+            if not task.done():
+                task.cancel()
 
     return full_response
 
 
 async def synthesize_speech_streaming(
     text: str,
-    audio_queue: asyncio.Queue,
+    websocket: ClientWriter,
     wait_for_event: asyncio.Event,
     set_event_when_done: asyncio.Event,
     speed: float = 2.0
 ) -> None:
     """
-    Convert text to speech using OpenAI's streaming TTS API and put chunks in a queue,
-    respecting an event chain for ordering.
+    Convert text to speech using OpenAI's streaming TTS API and send chunks to the
+    client, respecting an event chain for ordering.
     """
-    print(f"🎤 Starting TTS for: '{text[:30]}...'")
+    log.debug("🎤 Starting TTS for: '%.30s...'", text)
     try:
-        async with async_openai_client.audio.speech.with_streaming_response.create(
+        async with openai_client.audio.speech.with_streaming_response.create(
             model="tts-1",
             voice="alloy",
             input=text,
             speed=speed,  # Dynamic speed based on user request
             response_format="pcm"  # Raw PCM for lowest latency
         ) as response:
+            # Read ahead while earlier sentences are still streaming, so this
+            # sentence's audio is ready the moment its turn comes
+            prebuffer = []
+            async for chunk in iter_progressive_frames(response.iter_bytes()):
+                if not wait_for_event.is_set():
+                    prebuffer.append(chunk)
+                    continue
+                if prebuffer:
+                    for buffered in prebuffer:
+                        await websocket.send_audio(buffered)
+                    prebuffer = []
+                await websocket.send_audio(chunk)
+
+            # The whole sentence arrived before its turn
             await wait_for_event.wait()
-
-            async for chunk in response.iter_bytes(chunk_size=4096):
-                if chunk:
-                    stream_response = {
-                        "type": "audio_stream_pcm",
-                        "pcm_chunk": base64.b64encode(chunk).decode('utf-8'),
-                        "sample_rate": 24000,
-                        "channels": 1,
-                    }
-                    await audio_queue.put(stream_response)
+            for buffered in prebuffer:
+                await websocket.send_audio(buffered)
 
     except asyncio.CancelledError:
-        print(f"TTS task for '{text[:30]}...' cancelled.")
+        log.debug("TTS task for '%.30s...' cancelled.", text)
     except Exception as e:
-        print(f"❌ TTS streaming error for '{text[:30]}...': {e}")
+        log.error("❌ TTS streaming error for '%.30s...': %s", text, e)
     finally:
         set_event_when_done.set()
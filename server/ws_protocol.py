@@ -0,0 +1,224 @@
+import asyncio
+import base64
+import logging
+import struct
+import orjson
+from fastapi import WebSocket
+
+log = logging.getLogger(__name__)
+
+# Pre-serialized JSON envelopes for the high-frequency client messages.
+# Only the dynamic string is encoded per frame; the rest is a constant.
+_AI_STREAM_PREFIX = '{"type":"ai_response_stream","is_complete":false,"content":'
+_INTERIM_PREFIX = '{"type":"interim_transcription","text":'
+
+AI_STREAM_COMPLETE = '{"type":"ai_response_stream","content":"","is_complete":true}'
+STOP_AUDIO = '{"type":"stop_audio_playback"}'
+
+# Binary envelope for clients that connect with ?binary=1:
+# 1-byte type tag, little-endian uint16 payload length, UTF-8 payload
+TYPE_INTERIM = 0x01
+TYPE_STOP_AUDIO = 0x03
+TYPE_AUDIO = 0x04  # Payload is raw 16-bit PCM at PCM_SAMPLE_RATE, mono
+TYPE_AI_TEXT = 0x05
+TYPE_AI_COMPLETE = 0x06
+_ENVELOPE = struct.Struct("<BH")
+_MAX_PAYLOAD = 0xFFFF
+
+# OpenAI TTS pcm output format
+PCM_SAMPLE_RATE = 24000
+PCM_CHANNELS = 1
+_AUDIO_PREFIX = f'{{"type":"audio_stream_pcm","sample_rate":{PCM_SAMPLE_RATE},"channels":{PCM_CHANNELS},"pcm_chunk":"'
+
+
+def ai_stream_frame(content: str) -> str:
+    """Build an ai_response_stream frame for a chunk of streamed text"""
+    return _AI_STREAM_PREFIX + orjson.dumps(content).decode() + "}"
+
+
+def interim_frame(text: str) -> str:
+    """Build an interim_transcription frame"""
+    return _INTERIM_PREFIX + orjson.dumps(text).decode() + "}"
+
+
+def audio_frame(pcm: bytes) -> str:
+    """Build a base64 audio_stream_pcm frame for JSON clients"""
+    return _AUDIO_PREFIX + base64.b64encode(pcm).decode() + '"}'
+
+
+def binary_frame(tag: int, text: str = "") -> bytes:
+    """Build a binary envelope frame"""
+    data = text.encode()
+    if len(data) > _MAX_PAYLOAD:
+        # Cut at a character boundary so the client never decodes a split sequence
+        data = data[:_MAX_PAYLOAD].decode("utf-8", "ignore").encode()
+    return _ENVELOPE.pack(tag, len(data)) + data
+
+
+def audio_binary_frame(pcm: bytes) -> bytes:
+    """Build a binary envelope frame carrying raw PCM"""
+    return _ENVELOPE.pack(TYPE_AUDIO, len(pcm)) + pcm
+
+
+STOP_AUDIO_BINARY = binary_frame(TYPE_STOP_AUDIO)
+AI_STREAM_COMPLETE_BINARY = binary_frame(TYPE_AI_COMPLETE)
+
+
+# Frames a slow client may have queued before TTS producers wait for the
+# writer to catch up (~64 x 1920 B of PCM)
+MAX_QUEUED_FRAMES = 64
+
+# Queue placeholder for the single pending interim transcript
+_INTERIM_SLOT = object()
+
+# Queue sentinel: the writer stops once everything queued before it is sent
+_CLOSE = object()
+
+# Longest close(drain=True) waits for a slow client to take the backlog
+DRAIN_TIMEOUT = 5.0
+
+
+class _PCM(bytes):
+    """Raw PCM queued for a binary client; adjacent chunks are merged into one frame"""
+
+
+class ClientWriter:
+    """
+    Single writer task per client WebSocket. Producers enqueue frames without
+    waiting on the socket; text frames that pile up while a send is in flight
+    are merged into one JSON array message, and queued PCM into one audio frame.
+    """
+
+    def __init__(self, websocket: WebSocket, binary: bool = False):
+        self.websocket = websocket
+        self.binary = binary  # Client decodes binary envelopes for the streaming messages
+        self.queue = asyncio.Queue()
+        self._pending_interim = None  # Newest interim not yet written
+        self._drained = asyncio.Event()  # Set whenever the writer takes the backlog
+        self._task = None
+        self._error = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def send_text(self, frame: str):
+        if self._error:
+            raise self._error
+        self.queue.put_nowait(frame)
+
+    async def send_bytes(self, frame: bytes):
+        if self._error:
+            raise self._error
+        self.queue.put_nowait(frame)
+
+    async def send_interim(self, text: str):
+        """Queue an interim transcript; one still waiting on a slow client is replaced"""
+        if self._error:
+            raise self._error
+        queued = self._pending_interim is not None
+        self._pending_interim = text
+        if not queued:
+            self.queue.put_nowait(_INTERIM_SLOT)
+
+    def _interim_frame(self):
+        """Binary clients get a pre-encoded envelope sent with send_bytes; others a text frame"""
+        text, self._pending_interim = self._pending_interim, None
+        if self.binary:
+            return binary_frame(TYPE_INTERIM, text)
+        return interim_frame(text)
+
+    async def send_audio(self, pcm: bytes):
+        """Queue PCM, waiting while a slow client already has a full backlog"""
+        while self.queue.qsize() >= MAX_QUEUED_FRAMES and self._task and not self._task.done():
+            self._drained.clear()
+            await self._drained.wait()
+        if self.binary:
+            await self.send_bytes(_PCM(pcm))
+        else:
+            await self.send_text(audio_frame(pcm))
+
+    async def send_ai_text(self, content: str):
+        if self.binary:
+            await self.send_bytes(binary_frame(TYPE_AI_TEXT, content))
+        else:
+            await self.send_text(ai_stream_frame(content))
+
+    async def send_ai_complete(self):
+        if self.binary:
+            await self.send_bytes(AI_STREAM_COMPLETE_BINARY)
+        else:
+            await self.send_text(AI_STREAM_COMPLETE)
+
+    async def send_stop_audio(self):
+        if self.binary:
+            await self.send_bytes(STOP_AUDIO_BINARY)
+        else:
+            await self.send_text(STOP_AUDIO)
+
+    async def _send_texts(self, texts):
+        if len(texts) == 1:
+            await self.websocket.send_text(texts[0])
+        else:
+            await self.websocket.send_text("[" + ",".join(texts) + "]")
+
+    async def _run(self):
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                self._drained.set()
+
+                # Merge runs of text frames and runs of PCM; other binary
+                # frames go out on their own, all in order
+                texts = []
+                pcm = []
+                pcm_len = 0
+                closing = False
+                for frame in batch:
+                    if frame is _CLOSE:
+                        closing = True
+                        break
+                    if frame is _INTERIM_SLOT:
+                        frame = self._interim_frame()
+                    is_pcm = isinstance(frame, _PCM)
+
+                    # Flush the pending run when this frame cannot join it
+                    if pcm and (not is_pcm or pcm_len + len(frame) > _MAX_PAYLOAD):
+                        await self.websocket.send_bytes(audio_binary_frame(b"".join(pcm)))
+                        pcm = []
+                        pcm_len = 0
+                    if texts and isinstance(frame, bytes):
+                        await self._send_texts(texts)
+                        texts = []
+
+                    if is_pcm:
+                        pcm.append(frame)
+                        pcm_len += len(frame)
+                    elif isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        texts.append(frame)
+                if pcm:
+                    await self.websocket.send_bytes(audio_binary_frame(b"".join(pcm)))
+                if texts:
+                    await self._send_texts(texts)
+                if closing:
+                    return
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            log.error("❌ Client writer error: %s", e)
+            self._error = e
+        finally:
+            self._drained.set()  # Release producers waiting on a writer that stopped
+
+    async def close(self, drain: bool = False):
+        """Stop the writer; with drain=True, frames already queued are sent first"""
+        if self._task and not self._task.done():
+            if drain:
+                self.queue.put_nowait(_CLOSE)
+                await asyncio.wait((self._task,), timeout=DRAIN_TIMEOUT)
+        if self._task and not self._task.done():
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)